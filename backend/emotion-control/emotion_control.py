@@ -1,4 +1,3 @@
-import glob
 import os
 import shutil
 import subprocess
@@ -15,6 +14,18 @@ app = modal.App("liveportrait-emotion-control")
 volume = modal.Volume.from_name("liveportrait-cache", create_if_missing=True)
 volumes = {"/models": volume}
 
+S3_BUCKET = "private-hey-gen"
+
+# Block size for sequential reads from the S3 mount
+S3_READ_BLOCK_SIZE = 8 * 1024 * 1024
+
+# Multipart settings for boto3 uploads of results
+S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+S3_MULTIPART_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Controls closer than this to their defaults are treated as unchanged
+NO_OP_THRESHOLD = 1e-3
+
 
 def download_liveportrait_models():
     """Download LivePortrait pretrained models"""
@@ -29,6 +40,99 @@ def download_liveportrait_models():
     print("Models downloaded successfully!")
 
 
+def is_h264_yuv420p(video_path):
+    """Check whether the first video stream is already H.264 in yuv420p"""
+    result = subprocess.run(
+        [
+            "ffprobe",
+            "-v", "error",
+            "-select_streams", "v:0",
+            "-show_entries", "stream=codec_name,pix_fmt",
+            "-of", "csv=p=0",
+            video_path
+        ],
+        capture_output=True,
+        text=True
+    )
+    return result.returncode == 0 and result.stdout.strip() == "h264,yuv420p"
+
+
+def get_audio_codec(video_path):
+    """Return the codec name of the first audio stream, or None if there is none"""
+    result = subprocess.run(
+        [
+            "ffprobe",
+            "-v", "error",
+            "-select_streams", "a:0",
+            "-show_entries", "stream=codec_name",
+            "-of", "csv=p=0",
+            video_path
+        ],
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip() or None
+
+
+def is_nvenc_available():
+    """Check whether ffmpeg can encode with h264_nvenc in this container"""
+    result = subprocess.run(
+        [
+            "ffmpeg",
+            "-v", "error",
+            "-f", "lavfi",
+            "-i", "color=c=black:s=256x256",
+            "-frames:v", "1",
+            "-c:v", "h264_nvenc",
+            "-f", "null",
+            "-"
+        ],
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        print(f"h264_nvenc unavailable, using libx264:\n{result.stderr[-2000:]}")
+    return result.returncode == 0
+
+
+def encode_h264_video(input_path, output_path, use_nvenc=False, allow_stream_copy=False):
+    """
+    Normalize a video to H.264/yuv420p MP4 with AAC audio and faststart
+
+    Prefers a stream copy when allowed, then NVDEC/NVENC on the GPU when
+    available, and falls back to libx264
+    """
+    encoder_options = []
+    if allow_stream_copy:
+        # Keep AAC audio untouched, re-encode anything else to AAC
+        audio_codec = "copy" if get_audio_codec(input_path) == "aac" else "aac"
+        encoder_options.append(([], ["-c:v", "copy", "-c:a", audio_codec]))
+    if use_nvenc:
+        encoder_options.append(
+            (["-hwaccel", "cuda"], ["-c:v", "h264_nvenc", "-preset", "fast", "-rc", "vbr", "-cq", "23", "-b:v", "0", "-pix_fmt", "yuv420p", "-c:a", "aac"]))
+    encoder_options.append(([], ["-c:v", "libx264", "-preset", "faster", "-crf", "23", "-pix_fmt", "yuv420p", "-c:a", "aac"]))
+
+    for decode_options, video_options in encoder_options:
+        ffmpeg_command = [
+            "ffmpeg",
+            "-y",
+            *decode_options,
+            "-i", input_path,
+            *video_options,
+            "-movflags", "+faststart",
+            output_path
+        ]
+        result = subprocess.run(ffmpeg_command, capture_output=True)
+        if result.returncode == 0:
+            return
+        stderr_tail = result.stderr.decode(errors="ignore")[-2000:]
+        print(f"ffmpeg encode with {video_options[1]} failed, trying next encoder:\n{stderr_tail}")
+
+    raise RuntimeError(f"ffmpeg re-encode failed: {result.stderr.decode(errors='ignore')}")
+
+
 image = (
     modal.Image
     .from_registry("nvidia/cuda:12.1.1-devel-ubuntu20.04", add_python="3.10")
@@ -76,12 +180,92 @@ class EmotionControlResponse(BaseModel):
     gpu="A100-40GB",
     volumes={
         **volumes,
-        "/s3-mount": modal.CloudBucketMount("private-hey-gen", secret=s3_secret)
+        "/s3-mount": modal.CloudBucketMount(S3_BUCKET, secret=s3_secret)
     },
     timeout=1800,
     secrets=[s3_secret]
 )
 class EmotionControlServer:
+    @modal.enter()
+    def setup_s3_client(self):
+        """Create the S3 client used for multipart uploads of results"""
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+
+        self.s3_client = boto3.client("s3", region_name=os.environ.get("AWS_REGION"))
+        self.transfer_config = TransferConfig(
+            multipart_threshold=S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=S3_MULTIPART_CHUNK_SIZE,
+            max_concurrency=16,
+            use_threads=True
+        )
+
+    @modal.enter()
+    def check_nvenc(self):
+        """Probe NVENC once per container instead of on every request"""
+        self.use_nvenc = is_nvenc_available()
+
+    def run_liveportrait(self, request: EmotionControlRequest, source_image_path: str,
+                         driving_video_path: str, temp_dir: str) -> str:
+        """Run LivePortrait's inference script and return the generated video path"""
+        # Create retargeting info file for emotion controls
+        retargeting_info = {
+            'smile': request.smile_intensity,
+            'eye_openness': request.eye_openness,
+            'eyebrow': request.eyebrow_raise,
+            'pitch': request.head_pitch,
+            'yaw': request.head_yaw,
+            'roll': request.head_roll,
+            'eye_x': request.eye_gaze_x,
+            'eye_y': request.eye_gaze_y,
+            'mouth_open': request.mouth_open,
+            'expression_strength': request.expression_strength
+        }
+        
+        print(f"Applying emotion controls: {retargeting_info}")
+        
+        # Run LivePortrait inference
+        # For now, use source video as driving video (self-reenactment with retargeting)
+        output_dir = os.path.join(temp_dir, "output")
+        os.makedirs(output_dir, exist_ok=True)
+        
+        print("Running LivePortrait inference...")
+        command = [
+            "python",
+            "inference.py",
+            "-s", source_image_path,
+            "-d", driving_video_path,
+            "--output_dir", output_dir,
+            # Add retargeting parameters
+            "--flag_retarget_eyes", "1" if abs(request.eye_gaze_x) > 0.01 or abs(request.eye_gaze_y) > 0.01 else "0",
+            "--flag_retarget_mouth", "1" if abs(request.smile_intensity) > 0.01 or abs(request.mouth_open) > 0.01 else "0"
+        ]
+        
+        result = subprocess.run(
+            command,
+            cwd="/liveportrait",
+            capture_output=True,
+            text=True,
+            timeout=1500
+        )
+        
+        if result.returncode != 0:
+            print(f"LivePortrait stderr: {result.stderr}")
+            print(f"LivePortrait stdout: {result.stdout}")
+            raise RuntimeError(f"LivePortrait inference failed: {result.stderr}")
+        
+        print("LivePortrait processing complete!")
+        
+        # LivePortrait names its output "<source>--<driving>.mp4"
+        source_name = Path(source_image_path).stem
+        driving_name = Path(driving_video_path).stem
+        generated_video = os.path.join(output_dir, f"{source_name}--{driving_name}.mp4")
+        
+        if not os.path.exists(generated_video):
+            raise RuntimeError("LivePortrait did not produce output video")
+
+        return generated_video
+
     @modal.fastapi_endpoint(method="POST", requires_proxy_auth=True)
     def control_emotion(self, request: EmotionControlRequest) -> EmotionControlResponse:
         """
@@ -99,13 +283,22 @@ class EmotionControlServer:
         try:
             # Get input video from S3
             video_path = f"/s3-mount/{request.video_s3_key}"
-            
-            if not os.path.exists(video_path):
-                raise FileNotFoundError(f"Video not found at {video_path}")
-            
+
+            # Stage the video on local disk in large sequential reads so
+            # OpenCV and LivePortrait don't issue small reads against the S3 mount.
+            # Opening it directly doubles as the existence check on the mount.
+            print("Staging input video locally...")
+            local_video_path = os.path.join(temp_dir, "input.mp4")
+            try:
+                src = open(video_path, "rb")
+            except FileNotFoundError:
+                raise FileNotFoundError(f"Video not found at {video_path}") from None
+            with src, open(local_video_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, length=S3_READ_BLOCK_SIZE)
+
             # Extract first frame as source image
             print("Extracting source frame...")
-            cap = cv2.VideoCapture(video_path)
+            cap = cv2.VideoCapture(local_video_path)
             ret, first_frame = cap.read()
             cap.release()
             
@@ -115,102 +308,62 @@ class EmotionControlServer:
             source_image_path = os.path.join(temp_dir, "source.jpg")
             cv2.imwrite(source_image_path, first_frame)
             
-            # Create retargeting info file for emotion controls
-            retargeting_info = {
-                'smile': request.smile_intensity,
-                'eye_openness': request.eye_openness,
-                'eyebrow': request.eyebrow_raise,
-                'pitch': request.head_pitch,
-                'yaw': request.head_yaw,
-                'roll': request.head_roll,
-                'eye_x': request.eye_gaze_x,
-                'eye_y': request.eye_gaze_y,
-                'mouth_open': request.mouth_open,
-                'expression_strength': request.expression_strength
-            }
-            
-            print(f"Applying emotion controls: {retargeting_info}")
-            
-            # Run LivePortrait inference
-            # For now, use source video as driving video (self-reenactment with retargeting)
-            output_dir = os.path.join(temp_dir, "output")
-            os.makedirs(output_dir, exist_ok=True)
-            
-            print("Running LivePortrait inference...")
-            command = [
-                "python",
-                "inference.py",
-                "-s", source_image_path,
-                "-d", video_path,
-                "--output_dir", output_dir,
-                # Add retargeting parameters
-                "--flag_retarget_eyes", "1" if abs(request.eye_gaze_x) > 0.01 or abs(request.eye_gaze_y) > 0.01 else "0",
-                "--flag_retarget_mouth", "1" if abs(request.smile_intensity) > 0.01 or abs(request.mouth_open) > 0.01 else "0"
+            # With every control at its default the output equals the input,
+            # so skip inference and only normalize the staged upload
+            # (null fields fall back to their defaults)
+            control_deltas = [
+                request.smile_intensity,
+                request.eye_openness,
+                request.eyebrow_raise,
+                request.head_pitch,
+                request.head_yaw,
+                request.head_roll,
+                request.eye_gaze_x,
+                request.eye_gaze_y,
+                request.mouth_open
             ]
-            
-            result = subprocess.run(
-                command,
-                cwd="/liveportrait",
-                capture_output=True,
-                text=True,
-                timeout=1500
+            expression_strength = request.expression_strength if request.expression_strength is not None else 1.0
+            skip_inference = (
+                max(abs(delta or 0.0) for delta in control_deltas) < NO_OP_THRESHOLD
+                and abs(expression_strength - 1.0) < NO_OP_THRESHOLD
             )
-            
-            if result.returncode != 0:
-                print(f"LivePortrait stderr: {result.stderr}")
-                print(f"LivePortrait stdout: {result.stdout}")
-                raise RuntimeError(f"LivePortrait inference failed: {result.stderr}")
-            
-            print("LivePortrait processing complete!")
-            
-            # Find the generated video
-            generated_video = None
-            for fpath in glob.glob(os.path.join(output_dir, "**", "*.mp4"), recursive=True):
-                generated_video = fpath
-                break
-            
-            if not generated_video or not os.path.exists(generated_video):
-                raise RuntimeError("LivePortrait did not produce output video")
-            
-            # Re-encode with ffmpeg for better compatibility
+
             final_video_path = os.path.join(temp_dir, "final_video.mp4")
-            ffmpeg_command = [
-                "ffmpeg",
-                "-i", generated_video,
-                "-c:v", "libx264",
-                "-preset", "medium",
-                "-crf", "23",
-                "-pix_fmt", "yuv420p",
-                final_video_path
-            ]
-            subprocess.run(ffmpeg_command, check=True, capture_output=True)
+            if skip_inference:
+                print("All controls at defaults, skipping LivePortrait inference")
+                encode_h264_video(
+                    local_video_path,
+                    final_video_path,
+                    use_nvenc=self.use_nvenc,
+                    allow_stream_copy=is_h264_yuv420p(local_video_path)
+                )
+            else:
+                generated_video = self.run_liveportrait(
+                    request, source_image_path, local_video_path, temp_dir)
+                encode_h264_video(generated_video, final_video_path, use_nvenc=self.use_nvenc)
             print("Video processed successfully!")
             
             # Upload result to S3
             video_uuid = str(uuid.uuid4())
             s3_key = f"emotion-control/{video_uuid}.mp4"
-            s3_path = f"/s3-mount/{s3_key}"
-            os.makedirs(os.path.dirname(s3_path), exist_ok=True)
-            shutil.copy(final_video_path, s3_path)
+            self.s3_client.upload_file(
+                final_video_path,
+                S3_BUCKET,
+                s3_key,
+                ExtraArgs={"ContentType": "video/mp4"},
+                Config=self.transfer_config
+            )
             print(f"Saved video to S3: {s3_key}")
             
-            # Extract a preview frame
-            preview_s3_key = None
-            preview_path = os.path.join(temp_dir, "preview.jpg")
-            ffmpeg_preview = [
-                "ffmpeg",
-                "-i", video_path,
-                "-vf", "select='eq(n,0)'",
-                "-vframes", "1",
-                preview_path
-            ]
-            result = subprocess.run(ffmpeg_preview, capture_output=True)
-            
-            if result.returncode == 0 and os.path.exists(preview_path):
-                preview_s3_key = f"emotion-control/{video_uuid}_preview.jpg"
-                preview_s3_path = f"/s3-mount/{preview_s3_key}"
-                shutil.copy(preview_path, preview_s3_path)
-                print(f"Saved preview to S3: {preview_s3_key}")
+            # The preview is the input's first frame, already saved as the source image
+            preview_s3_key = f"emotion-control/{video_uuid}_preview.jpg"
+            self.s3_client.upload_file(
+                source_image_path,
+                S3_BUCKET,
+                preview_s3_key,
+                ExtraArgs={"ContentType": "image/jpeg"}
+            )
+            print(f"Saved preview to S3: {preview_s3_key}")
             
             return EmotionControlResponse(
                 video_s3_key=s3_key,